@@ -1,17 +1,23 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set
 import os
 import argparse
+import atexit
+import concurrent.futures
+import errno
+import functools
+import hashlib
 import json
 from pathlib import Path
 import shutil
 import sys
+import tempfile
+import threading
+import uuid
 
 import cli_ui as ui  # noqa
 import tankerci
 from tankerci.conan import TankerSource
 import tankerci.conan
-import tankerci.git
-import tankerci.gitlab
 from tankerci.build_info import DepsConfig
 
 
@@ -28,187 +34,521 @@ TARGET_LIST = [
     "x86_64-unknown-linux-gnu",
 ]
 
+# Android builders run concurrently, but they all share the same conan cache
+CONAN_LOCK = threading.Lock()
 
+# Apple prefixes symbols with '_'
+TANKER_SYMBOLS = "^_?tanker_.*"
+ARMERGE_CACHE_PATH = Path.home() / ".cache" / "tanker-armerge"
+CI_CACHE_PATH = Path.home() / ".cache" / "tanker-ci"
+
+# The files _prepare_profile generates in native/<triplet>
+NATIVE_FILE_NAMES = ["libtanker.a", "ctanker.rs"]
+
+ANDROID_NDK_REF = "android_ndk_installer/r22b@"
+
+# Removes discarded trees in the background, waited for at exit
+TRASH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+atexit.register(TRASH_EXECUTOR.shutdown)
+
+# cargo fmt and clippy give the same results for every profile of a target
+LINTED_TARGETS: Set[str] = set()
+LINTED_TARGETS_LOCK = threading.Lock()
+
+
+# (platform, arch, sdk) -> rust target triplet, sdk is only relevant for iOS
+RUST_TARGETS = {
+    ("Android", "armv7", None): "armv7-linux-androideabi",
+    ("Android", "armv8", None): "aarch64-linux-android",
+    ("Android", "x86_64", None): "x86_64-linux-android",
+    ("Android", "x86", None): "i686-linux-android",
+    ("Macos", "x86_64", None): "x86_64-apple-darwin",
+    ("Macos", "armv8", None): "aarch64-apple-darwin",
+    # TODO this is Tier 3, wait for a few weeks before being able to build for armv8 simulator
+    ("iOS", "armv8", "iphonesimulator"): "aarch64-apple-ios-sim",
+    ("iOS", "armv8", None): "aarch64-apple-ios",
+    ("iOS", "x86_64", "iphonesimulator"): "x86_64-apple-ios",
+    ("iOS", "x86_64", None): "x86_64-apple-ios",
+}
+
+
+@functools.lru_cache(maxsize=None)
 def profile_to_rust_target(platform: str, arch: str, sdk: Optional[str]) -> str:
-    if platform == "Android":
-        if arch == "armv7":
-            return "armv7-linux-androideabi"
-        elif arch == "armv8":
-            return "aarch64-linux-android"
-        elif arch == "x86_64":
-            return "x86_64-linux-android"
-        elif arch == "x86":
-            return "i686-linux-android"
-    elif platform == "Macos":
-        if arch == "x86_64":
-            return "x86_64-apple-darwin"
-        elif arch == "armv8":
-            return "aarch64-apple-darwin"
-    elif platform == "iOS":
-        if arch == "armv8":
-            # TODO this is Tier 3, wait for a few weeks before being able to build for armv8 simulator
-            if sdk == "iphonesimulator":
-                return "aarch64-apple-ios-sim"
-            else:
-                return "aarch64-apple-ios"
-        elif arch == "x86_64":
-            return "x86_64-apple-ios"
-    elif platform == "Linux":
+    if platform == "Linux":
         return "x86_64-unknown-linux-gnu"
-
-    raise Exception(f"Unsupported target architecture: {platform}-{arch}")
+    if platform != "iOS" or sdk != "iphonesimulator":
+        sdk = None
+    try:
+        return RUST_TARGETS[(platform, arch, sdk)]
+    except KeyError:
+        raise Exception(f"Unsupported target architecture: {platform}-{arch}") from None
+
+
+@functools.lru_cache(maxsize=None)
+def get_profile_settings(profile: str) -> Dict[str, str]:
+    # A single conan call, instead of one per tankerci.conan.get_profile_key
+    _, out = tankerci.run_captured("conan", "profile", "show", profile)
+    settings: Dict[str, str] = {}
+    section: Optional[str] = None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1]
+        elif section == "settings" and "=" in line:
+            key, value = line.split("=", 1)
+            settings[key.strip()] = value.strip()
+    return settings
 
 
 def get_android_bin_path() -> Path:
+    # Android builders run concurrently: hold the lock while looking up the
+    # cache so that conan is only queried once
+    with CONAN_LOCK:
+        return _find_android_bin_path()
+
+
+@functools.lru_cache(maxsize=1)
+def _find_android_bin_path() -> Path:
+    # The NDK package folder only depends on the reference and on the conan
+    # cache it was installed in, so it can be remembered across runs
+    cache_file = CI_CACHE_PATH / "android_bin_path.json"
+    cache_key = f"{ANDROID_NDK_REF}|{os.environ.get('CONAN_USER_HOME', '')}"
+    try:
+        cached_paths = json.loads(cache_file.read_text())
+    except (OSError, json.JSONDecodeError):
+        cached_paths = {}
+    cached_path = cached_paths.get(cache_key)
+    if cached_path and Path(cached_path).is_dir():
+        return Path(cached_path)
+
+    bin_path = _query_android_bin_path()
+    cached_paths[cache_key] = str(bin_path)
+    CI_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    tmp_cache_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+    tmp_cache_file.write_text(json.dumps(cached_paths))
+    os.replace(tmp_cache_file, cache_file)
+    return bin_path
+
+
+def _query_android_bin_path() -> Path:
     # We need to specify an android profile or conan can't find the binary
     # package. The specific profile is not important since there is only one
     # binary NDK, the recipe ignores the arch, api_level, etc.
-    tankerci.run(
-        "conan",
-        "install",
-        "android_ndk_installer/r22b@",
-        "--profile",
-        "android-armv7-release",
-    )
-    _, out = tankerci.run_captured(
-        "conan",
-        "info",
-        "android_ndk_installer/r22b@",
-        "--profile",
-        "android-armv7-release",
-        "--json",
-        "--paths",
-    )
+    # The json generator gives us the package folder, no need for a second
+    # graph resolution with conan info
+    with tempfile.TemporaryDirectory() as install_folder:
+        tankerci.run(
+            "conan",
+            "install",
+            ANDROID_NDK_REF,
+            "--profile",
+            "android-armv7-release",
+            "--generator",
+            "json",
+            "--install-folder",
+            install_folder,
+        )
+        build_info = Path(install_folder) / "conanbuildinfo.json"
+        out = build_info.read_text()
     try:
         info = json.loads(out)
-        package_path = Path(info[0]["package_folder"])
+        package_path = Path(info["dependencies"][0]["rootpath"])
         bin_path = package_path / "toolchains/llvm/prebuilt/linux-x86_64/bin"
         return bin_path
     except (json.JSONDecodeError, KeyError, IndexError):
         if out:
-            ui.error(f"Failed to parse output: {out}")
+            ui.error(f"Failed to parse {build_info.name}: {out}")
         raise
 
 
-def bind_gen(*, header_source: Path, output_file: Path, include_path: Path) -> None:
+def get_conan_user_home() -> Path:
+    return Path(os.environ.get("CONAN_USER_HOME", Path.home()))
+
+
+def get_cpu_count() -> int:
+    # os.cpu_count() returns the number of CPUs of the host, even when the
+    # container's cgroup only allows us to use some of them
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return max(1, int(quota) // int(period))
+    except (OSError, ValueError):
+        pass
+    try:
+        cgroup_v1 = Path("/sys/fs/cgroup/cpu")
+        quota_us = int((cgroup_v1 / "cpu.cfs_quota_us").read_text())
+        period_us = int((cgroup_v1 / "cpu.cfs_period_us").read_text())
+        if quota_us > 0:
+            return max(1, quota_us // period_us)
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+
+@functools.lru_cache(maxsize=1)
+def get_armerge_version() -> str:
+    _, out = tankerci.run_captured("armerge", "--version")
+    return out.strip()
+
+
+@functools.lru_cache(maxsize=1)
+def get_bindgen_version() -> str:
+    _, out = tankerci.run_captured("bindgen", "--version")
+    return out.strip()
+
+
+def discard_tree(path: Path, trash_dir: Path) -> None:
+    # Renaming is instant, the old tree is then removed while we keep working.
+    # trash_dir must be on the same filesystem as path, and outside of any
+    # directory that gets shipped, in case the removal fails or never runs.
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    trash_path = trash_dir / f"{path.name}-{uuid.uuid4().hex}"
+    os.rename(path, trash_path)
+    TRASH_EXECUTOR.submit(shutil.rmtree, trash_path, onerror=_log_removal_error)
+
+
+def _log_removal_error(function: Any, path: str, excinfo: Any) -> None:
+    ui.warning("Failed to remove", path, excinfo[1])
+
+
+def link_or_copy(src: Path, dest: Path) -> None:
+    # Never write through an existing file: it may be a hard link to a file
+    # of the conan cache
+    if dest.exists():
+        dest.unlink()
+    # Hard links are free, but only work within the same filesystem
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dest)
+
+
+def restore_from_cache(cached_file: Path, dest: Path) -> None:
+    link_or_copy(cached_file, dest)
+    # build.rs relies on cargo:rerun-if-changed, which compares mtimes: a
+    # cached file older than the previous build would go unnoticed
+    os.utime(dest)
+
+
+def try_restore_from_cache(cached_file: Path, dest: Path) -> bool:
+    # Other runs may replace the entry at any time, a missing file is a miss
+    try:
+        restore_from_cache(cached_file, dest)
+    except FileNotFoundError:
+        return False
+    ui.info("Using cached", cached_file)
+    return True
+
+
+def store_in_cache(src: Path, cached_file: Path) -> None:
+    # Other runs may be storing or reading the same entry: never unlink it,
+    # link it under a unique name and atomically move it into place instead
+    cached_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_cached_file = cached_file.with_name(
+        f".{cached_file.name}.{uuid.uuid4().hex}.tmp"
+    )
+    link_or_copy(src, tmp_cached_file)
+    os.replace(tmp_cached_file, cached_file)
+
+
+def bind_gen(
+    *, header_source: Path, output_file: Path, include_path: Path, force: bool = False
+) -> None:
+    # bindgen re-parses the whole header tree with libclang, reuse its output
+    # when neither the headers nor bindgen itself changed
+    flags = ["--no-layout-tests"]
+    key = hashlib.sha256()
+    key.update(get_bindgen_version().encode())
+    key.update(" ".join(flags).encode())
+    key.update(str(header_source.relative_to(include_path)).encode())
+    headers = [
+        Path(root) / name for root, _, files in os.walk(include_path) for name in files
+    ]
+    for header in sorted(headers):
+        key.update(str(header.relative_to(include_path)).encode())
+        key.update(header.read_bytes())
+    cached_output_file = CI_CACHE_PATH / "bindgen" / (key.hexdigest() + ".rs")
+    if not force and try_restore_from_cache(cached_output_file, output_file):
+        return
+
+    # Same as for libtanker.a: never leave a partial ctanker.rs for build.rs,
+    # and never share the temporary file with another run
+    tmp_output_file = output_file.with_name(
+        f"{output_file.name}.{uuid.uuid4().hex}.tmp"
+    )
     tankerci.run(
         "bindgen",
-        "--no-layout-tests",
+        *flags,
         str(header_source),
         "-o",
-        str(output_file),
+        str(tmp_output_file),
         "--",
         "-I",
         str(include_path),
     )
+    os.replace(tmp_output_file, output_file)
+    store_in_cache(output_file, cached_output_file)
 
 
 class Builder:
-    def __init__(self, *, src_path: Path, tanker_source: TankerSource, profile: str):
+    def __init__(
+        self,
+        *,
+        src_path: Path,
+        tanker_source: TankerSource,
+        profile: str,
+        force: bool = False,
+    ):
         self.src_path = src_path
         self.profile = profile
         self.tanker_source = tanker_source
-        self.platform = tankerci.conan.get_profile_key("settings.os", profile)
+        # ignore every cache, and replace their entries with fresh ones
+        self.force = force
+        settings = get_profile_settings(profile)
+        self.platform = settings["os"]
         self.sdk = None
         if self.platform == "iOS":
-            self.sdk = tankerci.conan.get_profile_key("settings.os.sdk", profile)
-        self.arch = tankerci.conan.get_profile_key("settings.arch", profile)
+            self.sdk = settings.get("os.sdk")
+        self.arch = settings["arch"]
         self.target_triplet = profile_to_rust_target(self.platform, self.arch, self.sdk)
-
-    def _is_android_target(self) -> bool:
-        return self.platform == "Android"
-
-    def _is_ios_target(self) -> bool:
-        return self.platform == "iOS"
-
-    def _is_host_target(self) -> bool:
-        return not (self._is_android_target() or self._is_ios_target())
+        # the platform never changes, compute these once
+        self._is_android_target = self.platform == "Android"
+        self._is_ios_target = self.platform == "iOS"
+        self._is_host_target = not (self._is_android_target or self._is_ios_target)
+        # Stripping is for the published archives, developers keep the debug
+        # symbols for their debugger. TANKER_NO_STRIP=1 also keeps them on CI.
+        self._strip_debug_symbols = False
+        if self._is_android_target and os.environ.get("CI"):
+            self._strip_debug_symbols = os.environ.get("TANKER_NO_STRIP") != "1"
 
     def _prepare_profile(self) -> None:
         conan_out = self.src_path / "conan" / "out" / self.profile
         package_path = conan_out / "package"
-        depsConfig = DepsConfig(self.src_path / "conan" / "out" / self.profile)
-
-        # copy includes
-        package_include = package_path / "include"
-        if package_include.exists():
-            shutil.rmtree(package_include)
-        package_include.mkdir(parents=True)
+        # read everything we need from the deps config once
+        depsConfig = DepsConfig(conan_out)
         include_path = Path(depsConfig["tanker"].include_dirs[0])
-        dest_include_path = package_include / "ctanker"
-        for header in include_path.glob("**/*"):
-            if header.is_dir():
-                continue
-            rel_dir = header.parent.relative_to(include_path)
-            header_dest_dir = dest_include_path / rel_dir
-            header_dest_dir.mkdir(parents=True, exist_ok=True)
-            ui.info_2(header, "->", header_dest_dir)
-            shutil.copy(header, header_dest_dir)
-
-        # copy all .a in deplibs
-        package_libs = package_path / "deplibs"
-        package_libs.mkdir(parents=True, exist_ok=True)
-        for lib_path in depsConfig.all_lib_paths():
-            shutil.copy(lib_path, package_libs)
+        lib_paths = list(depsConfig.all_lib_paths())
 
         native_path = self.src_path / "native" / self.target_triplet
         if native_path.exists():
-            shutil.rmtree(native_path)
+            discard_tree(native_path, self.src_path / ".trash")
         native_path.mkdir(parents=True)
-        # merge all .a in deplibs into one big libtanker.a
-        self._merge_all_libs(package_path, native_path)
+
+        cached_native_path = (
+            CI_CACHE_PATH / "native" / self._native_cache_key(include_path, lib_paths)
+        )
+        # Only restore complete entries, anything else is a miss and gets
+        # replaced below
+        complete = all(
+            (cached_native_path / name).exists() for name in NATIVE_FILE_NAMES
+        )
+        if cached_native_path.exists() and (self.force or not complete):
+            discard_tree(cached_native_path, CI_CACHE_PATH / ".trash")
+        elif complete:
+            ui.info("Using cached", cached_native_path)
+            for name in NATIVE_FILE_NAMES:
+                restore_from_cache(cached_native_path / name, native_path / name)
+            return
+
+        # armerge reads the archives straight from the conan packages, there
+        # is no need to stage them in a deplibs/ directory first. When several
+        # packages ship an archive with the same name, keep the last one, as
+        # the flat deplibs/ directory used to.
+        deplibs_by_name = {lib_path.name: lib_path for lib_path in lib_paths}
+        deplibs = [deplibs_by_name[name] for name in sorted(deplibs_by_name)]
+
+        # bindgen only needs the headers: run it while armerge, by far the
+        # longest step, merges the libraries
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            includes = executor.submit(
+                self._prepare_includes, include_path, package_path, native_path
+            )
+            libs = executor.submit(self._merge_all_libs, deplibs, native_path)
+            includes.result()
+            libs.result()
+
+        # Fill the cache entry aside, then move it into place so that other
+        # runs never see a partial entry. Only store the files this builder
+        # produced, not whatever else native_path may contain.
+        tmp_native_path = cached_native_path.with_name(
+            f"{cached_native_path.name}.{uuid.uuid4().hex}"
+        )
+        tmp_native_path.mkdir(parents=True)
+        for name in NATIVE_FILE_NAMES:
+            link_or_copy(native_path / name, tmp_native_path / name)
+        try:
+            os.rename(tmp_native_path, cached_native_path)
+        except OSError:
+            # another run filled the same entry in the meantime
+            shutil.rmtree(tmp_native_path)
+
+    def _native_cache_key(self, include_path: Path, lib_paths: List[Path]) -> str:
+        # Same trade-off as the armerge cache: file sizes and mtimes are
+        # enough to detect a new tanker package
+        key = hashlib.sha256()
+        # also invalidate the cache when the way we build native/ changes
+        key.update(Path(__file__).read_bytes())
+        key.update(self.target_triplet.encode())
+        key.update(get_armerge_version().encode())
+        key.update(get_bindgen_version().encode())
+        key.update(TANKER_SYMBOLS.encode())
+        if self._is_android_target:
+            key.update(ANDROID_NDK_REF.encode())
+        key.update(f"strip={self._strip_debug_symbols}".encode())
+        headers = [
+            Path(root) / name
+            for root, _, files in os.walk(include_path)
+            for name in files
+        ]
+        for path in sorted(headers) + sorted(lib_paths):
+            stat = path.stat()
+            key.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return key.hexdigest()
+
+    def _prepare_includes(
+        self, include_path: Path, package_path: Path, native_path: Path
+    ) -> None:
+        self._copy_includes(include_path, package_path / "include")
         bind_gen(
             header_source=include_path / "ctanker.h",
             output_file=native_path / "ctanker.rs",
             include_path=include_path,
+            force=self.force,
         )
 
-    def _merge_all_libs(self, package_path: Path, native_path: Path) -> None:
-        with tankerci.working_directory(package_path):
-            env = os.environ.copy()
-            if self._is_android_target():
-                android_bin_path = get_android_bin_path()
-                env["LD"] = str(android_bin_path / "ld.lld")
-                env["OBJCOPY"] = str(android_bin_path / "llvm-objcopy")
-                ui.info(f'Using {env["LD"]}')
-                ui.info(f'Using {env["OBJCOPY"]}')
-
-            if self._is_ios_target():
-                env["ARMERGE_LDFLAGS"] = "-bitcode_bundle"
-            libtanker_a = Path("libtanker.a")
-            if libtanker_a.exists():
-                libtanker_a.unlink()
-            # Apple prefixes symbols with '_'
+    def _copy_includes(self, include_path: Path, package_include: Path) -> None:
+        if package_include.exists():
+            discard_tree(package_include, self.src_path / ".trash")
+        dest_include_path = package_include / "ctanker"
+        sources = []
+        destinations = []
+        for root, _, files in os.walk(include_path):
+            # one mkdir per directory, not one per header, and all of them
+            # before the copies start
+            dest_dir = dest_include_path / Path(root).relative_to(include_path)
+            dest_dir.mkdir(parents=True)
+            for name in files:
+                sources.append(Path(root) / name)
+                destinations.append(dest_dir / name)
+        ui.info_2(include_path, "->", dest_include_path, f"({len(sources)} files)")
+        # Headers are only read from there on: hard link them, or copy them
+        # without their permission bits from another filesystem. Check the
+        # filesystem once rather than failing one os.link() per header.
+        # The destination tree was just created, nothing needs unlinking.
+        same_fs = include_path.stat().st_dev == dest_include_path.stat().st_dev
+        copy = os.link if same_fs else shutil.copyfile
+        # Copies mostly wait on syscalls, which release the GIL
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            # consume the iterator so that errors are raised here
+            list(executor.map(copy, sources, destinations))
+
+    def _merge_all_libs(self, deplibs: List[Path], native_path: Path) -> None:
+        env = os.environ.copy()
+        if self._is_android_target:
+            android_bin_path = get_android_bin_path()
+            env["LD"] = str(android_bin_path / "ld.lld")
+            env["OBJCOPY"] = str(android_bin_path / "llvm-objcopy")
+            ui.info(f'Using {env["LD"]}')
+            ui.info(f'Using {env["OBJCOPY"]}')
+
+        if self._is_ios_target:
+            env["ARMERGE_LDFLAGS"] = "-bitcode_bundle"
+        # armerge writes straight into native_path, there is no intermediate
+        # copy of the archive to write and read back
+        libtanker_a = native_path / "libtanker.a"
+        cached_libtanker_a = ARMERGE_CACHE_PATH / (
+            self._armerge_cache_key(deplibs, env) + ".a"
+        )
+        if not self.force and try_restore_from_cache(cached_libtanker_a, libtanker_a):
+            return
+
+        # Use a temporary file in the same directory, so that a failed merge
+        # or strip never leaves a partial libtanker.a for build.rs to use. Its
+        # name is unique, so that two merges never share it.
+        merged_a = libtanker_a.with_name(f"{libtanker_a.name}.{uuid.uuid4().hex}.tmp")
+        tankerci.run(
+            "armerge",
+            "--keep-symbols",
+            TANKER_SYMBOLS,
+            "--output",
+            str(merged_a),
+            *(str(lib) for lib in deplibs),
+            env=env,
+        )
+        if self._strip_debug_symbols:
+            llvm_strip = get_android_bin_path() / "llvm-strip"
+            # HACK: Android forces debug symbols, we need to patch the
+            # toolchain to remove them. Until then, strip them here.
             tankerci.run(
-                "armerge --keep-symbols '^_?tanker_.*' --output libtanker.a"
-                " deplibs/*.a",
-                shell=True,
-                env=env,
+                str(llvm_strip),
+                "--strip-debug",
+                "--strip-unneeded",
+                str(merged_a),
+                "-o",
+                str(libtanker_a),
             )
-            if self._is_android_target():
-                llvm_strip = android_bin_path / "llvm-strip"
-                # HACK: Android forces debug symbols, we need to patch the
-                # toolchain to remove them. Until then, strip them here.
-                tankerci.run(
-                    str(llvm_strip), "--strip-debug", "--strip-unneeded", "libtanker.a"
-                )
-            shutil.copy("libtanker.a", native_path)
-
-    def prepare(self, update: bool, tanker_ref: Optional[str] = None) -> None:
-        tanker_deployed_ref = tanker_ref
-        if self.tanker_source == TankerSource.DEPLOYED and not tanker_ref:
-            tanker_deployed_ref = "tanker/latest-stable@"
-        tankerci.conan.install_tanker_source(
-            self.tanker_source,
-            output_path=Path("conan") / "out",
-            profiles=[self.profile],
-            update=update,
-            tanker_deployed_ref=tanker_deployed_ref,
-        )
+            merged_a.unlink()
+        else:
+            os.replace(merged_a, libtanker_a)
+        store_in_cache(libtanker_a, cached_libtanker_a)
+
+    def _armerge_cache_key(self, deplibs: List[Path], env: Dict[str, str]) -> str:
+        # Hashing the archives themselves would cost about as much as merging
+        # them, their name, size and mtime are enough to detect changes
+        key = hashlib.sha256()
+        key.update(get_armerge_version().encode())
+        key.update(TANKER_SYMBOLS.encode())
+        key.update(self.target_triplet.encode())
+        for var in ["LD", "OBJCOPY", "ARMERGE_LDFLAGS"]:
+            key.update(f"{var}={env.get(var, '')}".encode())
+        key.update(f"strip={self._strip_debug_symbols}".encode())
+        for lib in deplibs:
+            stat = lib.stat()
+            key.update(f"{lib.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return key.hexdigest()
+
+    def _install_manifest_key(self, tanker_deployed_ref: str) -> str:
+        profile_path = get_conan_user_home() / ".conan" / "profiles" / self.profile
+        key = hashlib.blake2b()
+        key.update(self.profile.encode())
+        key.update(tanker_deployed_ref.encode())
+        if profile_path.exists():
+            key.update(profile_path.read_bytes())
+        return key.hexdigest()
+
+    def _install_manifest_path(self) -> Path:
+        return self.src_path / "conan" / "out" / self.profile / ".manifest"
+
+    def is_installed(self, tanker_deployed_ref: str) -> bool:
+        manifest_path = self._install_manifest_path()
+        if not manifest_path.exists():
+            return False
+        if manifest_path.read_text() != self._install_manifest_key(tanker_deployed_ref):
+            return False
+        # The packages may have been removed from the conan cache since, in
+        # which case conan install has to restore them
+        try:
+            deps_config = DepsConfig(manifest_path.parent)
+            include_path = Path(deps_config["tanker"].include_dirs[0])
+            lib_paths = list(deps_config.all_lib_paths())
+        except (OSError, KeyError, IndexError):
+            return False
+        return all(path.exists() for path in [include_path, *lib_paths])
+
+    def set_installed(self, tanker_deployed_ref: Optional[str]) -> None:
+        manifest_path = self._install_manifest_path()
+        if tanker_deployed_ref:
+            manifest_path.write_text(self._install_manifest_key(tanker_deployed_ref))
+        elif manifest_path.exists():
+            manifest_path.unlink()
+
+    def prepare(self) -> None:
         self._prepare_profile()
 
     def test(self) -> None:
-        if not self._is_host_target():
+        if not self._is_host_target:
             if self.target_triplet == "aarch64-apple-ios-sim":
                 tankerci.run(
                     "cargo",
@@ -226,21 +566,78 @@ class Builder:
                 )
             ui.info(self.profile, "is a cross-compiled target, skipping tests")
             return
-        tankerci.run("cargo", "fmt", "--", "--check", cwd=self.src_path)
+        with LINTED_TARGETS_LOCK:
+            lint = self.target_triplet not in LINTED_TARGETS
+            LINTED_TARGETS.add(self.target_triplet)
+        test_args = []
+        if lint:
+            # cargo fmt does not build anything, hide it behind clippy
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                fmt = executor.submit(
+                    tankerci.run, "cargo", "fmt", "--", "--check", cwd=self.src_path
+                )
+                clippy = executor.submit(
+                    tankerci.run,
+                    "cargo",
+                    "clippy",
+                    "--all-targets",
+                    "--",
+                    "--deny",
+                    "warnings",
+                    "--allow",
+                    "unknown-lints",
+                    cwd=self.src_path,
+                )
+                fmt.result()
+                clippy.result()
+            # clippy --all-targets has fetched every dependency, including
+            # dev-dependencies, no need to look at the registry again
+            test_args.append("--offline")
         tankerci.run(
             "cargo",
-            "clippy",
-            "--all-targets",
-            "--",
-            "--deny",
-            "warnings",
-            "--allow",
-            "unknown-lints",
+            "test",
+            *test_args,
+            "--target",
+            self.target_triplet,
             cwd=self.src_path,
         )
-        tankerci.run(
-            "cargo", "test", "--target", self.target_triplet, cwd=self.src_path
-        )
+
+
+def install_tanker(
+    tanker_source: TankerSource,
+    builders: List[Builder],
+    *,
+    update: bool,
+    tanker_ref: Optional[str],
+    force: bool,
+) -> None:
+    tanker_deployed_ref = tanker_ref
+    if tanker_source == TankerSource.DEPLOYED and not tanker_ref:
+        tanker_deployed_ref = "tanker/latest-stable@"
+    # Only a pinned deployed package is guaranteed to stay the same between
+    # two runs
+    pinned_ref = None
+    if tanker_source == TankerSource.DEPLOYED and not update:
+        pinned_ref = tanker_ref
+    to_install = []
+    for builder in builders:
+        if pinned_ref and not force and builder.is_installed(pinned_ref):
+            ui.info(pinned_ref, "is already installed for", builder.profile)
+        else:
+            builder.set_installed(None)
+            to_install.append(builder)
+    if not to_install:
+        return
+    # A single conan install resolves the graph once for all the profiles
+    tankerci.conan.install_tanker_source(
+        tanker_source,
+        output_path=Path("conan") / "out",
+        profiles=[builder.profile for builder in to_install],
+        update=update,
+        tanker_deployed_ref=tanker_deployed_ref,
+    )
+    for builder in to_install:
+        builder.set_installed(pinned_ref)
 
 
 def build_and_test(
@@ -250,21 +647,74 @@ def build_and_test(
     update: bool = False,
     test: bool = True,
     tanker_ref: Optional[str] = None,
+    force: bool = False,
 ) -> None:
     if os.environ.get("CI"):
         os.environ["RUSTFLAGS"] = "-D warnings"
-    for profile in profiles:
-        builder = Builder(
-            src_path=Path.cwd(), tanker_source=tanker_source, profile=profile
+    # All cargo invocations must share the same build cache
+    os.environ.setdefault("CARGO_TARGET_DIR", str(Path.cwd() / "target"))
+    os.environ.setdefault("CARGO_BUILD_JOBS", str(get_cpu_count()))
+    # Let sccache share compiled crates across targets and pipelines, its
+    # directory lives in the checkout so that CI jobs can cache it
+    if shutil.which("sccache"):
+        os.environ.setdefault("RUSTC_WRAPPER", "sccache")
+        os.environ.setdefault("SCCACHE_DIR", str(Path.cwd() / ".cache" / "sccache"))
+
+    builders = [
+        Builder(
+            src_path=Path.cwd(),
+            tanker_source=tanker_source,
+            profile=profile,
+            force=force,
         )
-        builder.prepare(update, tanker_ref)
+        for profile in profiles
+    ]
+    install_tanker(
+        tanker_source, builders, update=update, tanker_ref=tanker_ref, force=force
+    )
+    # Resolve the NDK before starting the pool, rather than having every
+    # Android builder wait on CONAN_LOCK behind the first one
+    if any(builder._is_android_target for builder in builders):
+        get_android_bin_path()
+
+    def build_one(builder: Builder) -> None:
+        builder.prepare()
         # tankerci.run("cargo", "build")
         if test:
             builder.test()
 
+    def build_group(group: List[Builder]) -> None:
+        for builder in group:
+            build_one(builder)
+
+    # Each profile has its own conan/out/<profile> directory, but profiles of
+    # the same target (debug and release, for instance) share
+    # native/<triplet>: build those one after the other, as before, and only
+    # run distinct targets concurrently. The work is spent waiting on
+    # subprocesses, so threads are enough
+    groups: Dict[str, List[Builder]] = {}
+    for builder in builders:
+        groups.setdefault(builder.target_triplet, []).append(builder)
+    max_workers = min(len(groups), get_cpu_count())
+    # Build one profile at a time, to get readable logs when debugging
+    if os.environ.get("TANKER_SERIAL") == "1":
+        max_workers = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(build_group, group) for group in groups.values()]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                # Fail fast: don't start the profiles still waiting for a worker
+                for pending in futures:
+                    pending.cancel()
+                raise
+
 
 def deploy(args: argparse.Namespace) -> None:
-    compiled_targets = [p.name for p in Path("native").iterdir() if p.is_dir()]
+    # DirEntry.is_dir() reuses the file type returned by readdir, no stat
+    with os.scandir("native") as entries:
+        compiled_targets = {entry.name for entry in entries if entry.is_dir()}
     missing_targets = [
         target for target in TARGET_LIST if target not in compiled_targets
     ]
@@ -278,6 +728,28 @@ def deploy(args: argparse.Namespace) -> None:
     tankerci.run("cargo", "publish", "--allow-dirty", f"--registry={registry}")
 
 
+def reset_branch(args: argparse.Namespace) -> None:
+    # Only this subcommand needs it, don't import it on every startup
+    import tankerci.git
+
+    fallback = os.environ["CI_COMMIT_REF_NAME"]
+    ref = tankerci.git.find_ref(
+        Path.cwd(), [f"origin/{args.branch}", f"origin/{fallback}"]
+    )
+    tankerci.git.reset(Path.cwd(), ref, clean=False)
+
+
+def download_artifacts(args: argparse.Namespace) -> None:
+    # Pulls python-gitlab in, only import it when actually used
+    import tankerci.gitlab
+
+    tankerci.gitlab.download_artifacts(
+        project_id=args.project_id,
+        pipeline_id=args.pipeline_id,
+        job_name=args.job_name,
+    )
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -299,6 +771,9 @@ def main() -> None:
         default=TankerSource.EDITABLE,
         dest="tanker_source",
     )
+    build_parser.add_argument(
+        "--force", action="store_true", default=False, dest="force"
+    )
     prepare_parser = subparsers.add_parser("prepare")
     prepare_parser.add_argument(
         "--profile", dest="profiles", action="append", required=True
@@ -313,6 +788,9 @@ def main() -> None:
     prepare_parser.add_argument(
         "--update", action="store_true", default=False, dest="update"
     )
+    prepare_parser.add_argument(
+        "--force", action="store_true", default=False, dest="force"
+    )
 
     reset_branch_parser = subparsers.add_parser("reset-branch")
     reset_branch_parser.add_argument("branch", nargs="?")
@@ -329,9 +807,16 @@ def main() -> None:
     if args.home_isolation:
         tankerci.conan.set_home_isolation()
         tankerci.conan.update_config()
+        # Logged so that CI jobs know which directory to cache
+        ui.info("Using conan user home", get_conan_user_home())
 
     if args.command == "build-and-test":
-        build_and_test(args.tanker_source, args.profiles, tanker_ref=args.tanker_ref)
+        build_and_test(
+            args.tanker_source,
+            args.profiles,
+            tanker_ref=args.tanker_ref,
+            force=args.force,
+        )
     elif args.command == "deploy":
         deploy(args)
     elif args.command == "prepare":
@@ -341,19 +826,12 @@ def main() -> None:
             test=False,
             update=args.update,
             tanker_ref=args.tanker_ref,
+            force=args.force,
         )
     elif args.command == "reset-branch":
-        fallback = os.environ["CI_COMMIT_REF_NAME"]
-        ref = tankerci.git.find_ref(
-            Path.cwd(), [f"origin/{args.branch}", f"origin/{fallback}"]
-        )
-        tankerci.git.reset(Path.cwd(), ref, clean=False)
+        reset_branch(args)
     elif args.command == "download-artifacts":
-        tankerci.gitlab.download_artifacts(
-            project_id=args.project_id,
-            pipeline_id=args.pipeline_id,
-            job_name=args.job_name,
-        )
+        download_artifacts(args)
     else:
         parser.print_help()
         sys.exit(1)